@@ -11,6 +11,11 @@ Convert 'labelme' project's output data to a dataset for OCR model training.
 2. Crop the image using 'bbox' and save it.
 3. Write a label for each cropped image to the label file.
 
+* A bbox is cropped when right <= width, lower <= height and it has a non-zero width and height.
+  Its right and lower edges may end exactly on the image border, since crop boxes exclude them.
+  Any other bbox is written to 'error.txt' instead. Earlier versions also logged boxes ending on the border,
+  so datasets converted before this rule may contain fewer crops.
+
 
 ## Usage example:
     python3 convert.py \
@@ -57,12 +62,33 @@ import os
 import sys
 import json
 import time
-import bisect
 import shutil
 import argparse
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from PIL import Image
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png"})
+
+PENDING_PER_WORKER = 4
+
+# The process pool already fills the cores, so each worker gets a single saver thread.
+SAVE_WORKERS = 1
+
+_saver = None
+
 
 def run(input_path, output_path, log):
     """ Convert 'labelme' project's output data to a dataset for OCR model training. """
@@ -77,99 +103,195 @@ def run(input_path, output_path, log):
     else:
         os.makedirs(output_path)
 
-    files, count, json_files, json_count, image_files, image_count = get_files(input_path)
+    json_count, image_files, image_count, json_by_name = get_files(input_path)
 
     if json_count != image_count:
         sys.exit(f"The number of json files and image files does not match exactly")
 
     start_time = time.time()
-    labels = open(os.path.join(output_path, "labels.txt"), "w", encoding="utf8")
-
-    digits = len(str(image_count))
-    for ii, image_file in enumerate(image_files):
-        if (ii + 1) % 100 == 0:
-            print(("\r%{}d / %{}d Processing !!".format(digits, digits)) % (ii + 1, count), end="")
+    labels = open(os.path.join(output_path, "labels.txt"), "w", encoding="utf8", buffering=1 << 20)
 
-        filename, ext = os.path.splitext(image_file)
+    jobs = []
+    for image_file, filename, ext, input_image_path in image_files:
         # print(f"image_file: {image_file}, filename: {filename}")
 
-        json_file = get_json_file(json_files, json_count, filename)
+        json_file = json_by_name.get(filename)
         if json_file is None:
             print(f"Can't find '{filename}' json file.")
             continue
 
-        with open(os.path.join(input_path, json_file)) as f:
-            json_data = json.load(f)
+        jobs.append((image_file, filename, ext, input_image_path, f"{input_path}/{json_file}"))
 
-        with Image.open(os.path.join(input_path, image_file)) as img:
-            for jj, shape in enumerate(json_data["shapes"]):
-                label = shape["label"]
-                bbox = get_bbox(shape["points"])
+    digits = len(str(image_count))
+    progress_fmt = f"\r%{digits}d / %{digits}d Processing !!"
+    max_workers = max(1, (os.cpu_count() or 1) - 2)
+    # Several jobs per worker keep the pool busy while a slow image at the head of the window is awaited.
+    max_pending = PENDING_PER_WORKER * max_workers
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Keep at most max_pending images in flight and drain them in submission order,
+        # so labels.txt and the error log keep the sorted image order from run to run.
+        jobs = iter(jobs)
+        pending = deque()
+        done = 0
+        while True:
+            for job in islice(jobs, max_pending - len(pending)):
+                pending.append(executor.submit(process_one, *job, output_path))
+
+            if not pending:
+                break
+
+            lines, errors = pending.popleft().result()
+            labels.write(lines)
+            log.write(errors)
+
+            done += 1
+            if done % 100 == 0:
+                sys.stdout.write(progress_fmt % (done, image_count))
 
-                if bbox[0] >= img.size[0] or bbox[1] >= img.size[1] or bbox[2] >= img.size[0] or bbox[3] >= img.size[1]:
-                    # print(f"{image_file} {label} label's bbox error: {bbox}")
-                    log.write(f"'{image_file}'s {label} bbox: '{bbox}'\n")
-                    continue
+    elapsed_time = (time.time() - start_time) / 60.
+    print("\n- processing time: %.1fmin" % elapsed_time)
+
+    labels.close()
+
+
+def process_one(image_file, filename, ext, input_image_path, input_json_path, output_path):
+    """ Crop and save every labeled region of a single image. Runs in a worker process. """
+
+    lines = []
+    errors = []
+
+    shapes = load_shapes(input_json_path)
+
+    with Image.open(input_image_path) as img:
+        # Only the header has been read so far, so validate every bbox before any pixel is decoded.
+        width, height = img.size
+        crops = []
+        for jj, (shape, bbox) in enumerate(zip(shapes, get_bboxes(shapes))):
+            label = shape["label"]
+
+            # get_bboxes orders each axis, so checking the far edges and a non-empty extent covers the near edges too.
+            # Crop boxes exclude their right and lower edges, so a bbox may end exactly on the image border.
+            if bbox[2] > width or bbox[3] > height or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                # print(f"{image_file} {label} label's bbox error: {bbox}")
+                errors.append(f"'{image_file}'s {label} bbox: '{bbox}'\n")
+                continue
 
-                output_file = f"{filename}_{jj:03d}{ext}"
+            crops.append((f"{filename}_{jj:03d}{ext}", label, bbox))
+
+        if not crops:
+            return "", "".join(errors)
+
+        # zlib level 1 encodes PNG crops several times faster than Pillow's default level 6.
+        save_options = {"compress_level": 1} if ext.lower() == ".png" else {}
+
+        # A bbox covering the whole image is copied byte for byte; the first real crop decodes the pixels.
+        full_bbox = [0, 0, width, height]
+        saver = get_saver()
+        saves = []
+        for output_file, label, bbox in crops:
+            if bbox == full_bbox:
+                saves.append(saver.submit(shutil.copyfile, input_image_path, f"{output_path}/{output_file}"))
+            else:
                 crop_image = img.crop(bbox)
-                crop_image.save(os.path.join(output_path, output_file))
+                saves.append(saver.submit(crop_image.save, f"{output_path}/{output_file}", **save_options))
 
-                labels.write(f"{output_file}\t{label}\n")
+            lines.append(f"{output_file}\t{label}\n")
 
-    elapsed_time = (time.time() - start_time) / 60.
-    print("\n- processing time: %.1fmin" % elapsed_time)
+        # Wait for this image's crops so their labels are only reported once the files exist.
+        for save in saves:
+            save.result()
 
-    labels.close()
+    return "".join(lines), "".join(errors)
 
 
-def get_json_file(json_files, json_count, filename):
-    """ Search for json file with the same name as image file """
+def get_saver():
+    """ Thread pool that encodes and writes crops while the worker keeps cropping (Pillow releases the GIL) """
 
-    idx = bisect.bisect(json_files, filename)
+    global _saver
+    if _saver is None:
+        _saver = ThreadPoolExecutor(max_workers=SAVE_WORKERS)
 
-    if idx < 0 or idx >= json_count:
-        return None
+    return _saver
 
-    return json_files[idx]
 
+def load_shapes(json_path):
+    """ Read only the 'shapes' array, skipping the embedded base64 'imageData' when ijson is available """
 
-def get_bbox(points):
-    left = int(min(points[0][0], points[1][0]))
-    upper = int(min(points[0][1], points[1][1]))
-    right = int(max(points[0][0], points[1][0]))
-    lower = int(max(points[0][1], points[1][1]))
+    # Parsers are tried fastest-first for labelme output: the early-exit ijson walk never reads 'imageData',
+    # then orjson parses the whole file faster than the stdlib json fallback.
+    if ijson is not None:
+        with open(json_path, "rb") as f:
+            builder = None
+            for prefix, event, value in ijson.parse(f, use_float=True):
+                if builder is None:
+                    if prefix == "shapes" and event == "start_array":
+                        builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                    continue
 
-    bbox = [left, upper, right, lower]
-    # print(f"bbox: {bbox}")
+                builder.event(event, value)
+                # labelme writes 'shapes' before 'imageData', so stop reading as soon as the array closes.
+                if prefix == "shapes" and event == "end_array":
+                    return builder.value
 
-    return bbox
+        raise KeyError("shapes")
 
+    if orjson is not None:
+        with open(json_path, "rb") as f:
+            json_data = orjson.loads(f.read())
 
-def get_files(path, except_file=""):
-    file_list = []
-    json_files = []
-    image_files = []
+        return json_data["shapes"]
 
-    for file in os.listdir(path):
-        if file.startswith(".") or file == os.path.basename(except_file):
-            print('except file: ', file)
-            continue
+    with open(json_path) as f:
+        json_data = json.load(f)
 
-        file_list.append(file)
-        _, ext = os.path.splitext(file)
-        if ext == ".json":
-            json_files.append(file)
-        elif ext in [".jpg", ".JPG", ".jpeg", ".JPEG", ".png", ".PNG"]:
-            image_files.append(file)
-        else:
-            sys.exit(f"Invalid file '{file}'.")
-
-    file_list.sort()
-    json_files.sort()
+    return json_data["shapes"]
+
+
+def get_bboxes(shapes):
+    """ Compute the bbox of every shape in one pass, without a function call per shape """
+
+    bboxes = []
+    for shape in shapes:
+        points = shape["points"]
+        (x0, y0), (x1, y1) = points[0], points[1]
+
+        left, right = (x0, x1) if x0 < x1 else (x1, x0)
+        upper, lower = (y0, y1) if y0 < y1 else (y1, y0)
+
+        bboxes.append([int(left), int(upper), int(right), int(lower)])
+    # print(f"bboxes: {bboxes}")
+
+    return bboxes
+
+
+def get_files(path, except_file=""):
+    json_by_name = {}
+    image_files = []
+    except_name = os.path.basename(except_file)
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            file = entry.name
+            if file.startswith(".") or file == except_name:
+                print('except file: ', file)
+                continue
+
+            filename, sep, suffix = file.rpartition(".")
+            suffix = suffix.lower()
+            if not sep:
+                sys.exit(f"Invalid file '{file}'.")
+            elif suffix == "json":
+                json_by_name[filename] = file
+            elif suffix in IMAGE_EXTENSIONS:
+                image_files.append((file, filename, file[len(filename):], entry.path))
+            else:
+                sys.exit(f"Invalid file '{file}'.")
+
+    # Images are paired with json files through json_by_name, so only the image list needs to be sorted.
     image_files.sort()
 
-    return file_list, len(file_list), json_files, len(json_files), image_files, len(image_files)
+    return len(json_by_name), image_files, len(image_files), json_by_name
 
 
 def create_working_directory(root, sub_dirs=None):